@@ -17,9 +17,27 @@ import contextlib
 import os
 import re
 
+try:
+    from shlex import quote as _quote
+except ImportError:  # Python 2.
+    from pipes import quote as _quote  # pylint: disable=deprecated-module
+
 # goto label written to the end of Windows batch files for exiting a script.
 _SCRIPT_END_LABEL = '_pw_end'
 
+# Valid environment variable names.
+_NAME_RE = re.compile(r'\A[A-Za-z_][A-Za-z0-9_]*\Z')
+
+try:
+    # In python2, unicode is a distinct type.
+    _STR_TYPES = (str, unicode)  # pylint: disable=undefined-variable
+except NameError:
+    _STR_TYPES = (str, )
+
+# Wrapped around echo commands in POSIX shell scripts so they can be silenced.
+_POSIX_QUIET_START = 'if [ -z "${PW_ENVSETUP_QUIET:-}" ]; then\n'
+_POSIX_QUIET_END = 'fi\n'
+
 
 class BadNameType(TypeError):
     pass
@@ -46,12 +64,17 @@ class UnexpectedAction(ValueError):
 
 
 class _Action(object):  # pylint: disable=useless-object-inheritance
-    def unapply(self, env, orig_env):  # pylint: disable=no-self-use
-        del env, orig_env  # Only used in _VariableAction and subclasses.
+    def render_windows(self):
+        """Returns the Windows batch file text for this action."""
+        raise NotImplementedError
+
+    def render_posix(self):
+        """Returns the POSIX shell script text for this action."""
+        raise NotImplementedError
 
 
 class _VariableAction(_Action):
-    # pylint: disable=redefined-builtin,too-few-public-methods
+    # pylint: disable=redefined-builtin,too-few-public-methods,abstract-method
     # pylint: disable=keyword-arg-before-vararg
     def __init__(self, name, value, allow_empty_values=False, *args, **kwargs):
         super(_VariableAction, self).__init__(*args, **kwargs)
@@ -62,49 +85,40 @@ class _VariableAction(_Action):
         self._check()
 
     def _check(self):
-        try:
-            # In python2, unicode is a distinct type.
-            valid_types = (str, unicode)  # pylint: disable=undefined-variable
-        except NameError:
-            valid_types = (str, )
-
-        if not isinstance(self.name, valid_types):
+        # Compare exact types rather than using isinstance(); names and values
+        # are always plain strings and this runs for every action.
+        # pylint: disable=unidiomatic-typecheck
+        if type(self.name) not in _STR_TYPES:
             raise BadNameType('variable name {!r} not of type str'.format(
                 self.name))
-        if not isinstance(self.value, valid_types):
+        if type(self.value) not in _STR_TYPES:
             raise BadValueType('{!r} value {!r} not of type str'.format(
                 self.name, self.value))
 
         # Empty strings as environment variable values have different behavior
-        # on different operating systems. Just don't allow them.
-        if not self.allow_empty_values and self.value == '':
-            raise EmptyValue('{!r} value {!r} is the empty string'.format(
-                self.name, self.value))
-
-        # Many tools have issues with newlines in environment variable values.
-        # Just don't allow them.
-        if '\n' in self.value:
-            raise NewlineInValue('{!r} value {!r} contains a newline'.format(
-                self.name, self.value))
-
-        if not re.match(r'^[A-Z_][A-Z0-9_]*$', self.name, re.IGNORECASE):
+        # on different operating systems. Many tools have issues with newlines
+        # in environment variable values. Just don't allow either.
+        if not self.value or '\n' in self.value:
+            if not self.value and not self.allow_empty_values:
+                raise EmptyValue('{!r} value {!r} is the empty string'.format(
+                    self.name, self.value))
+            if '\n' in self.value:
+                raise NewlineInValue(
+                    '{!r} value {!r} contains a newline'.format(
+                        self.name, self.value))
+
+        if not _NAME_RE.match(self.name):
             raise BadVariableName('bad variable name {!r}'.format(self.name))
 
-    def unapply(self, env, orig_env):
-        if self.name in orig_env:
-            env[self.name] = orig_env[self.name]
-        else:
-            env.pop(self.name, None)
-
 
 class Set(_VariableAction):
     """Set a variable."""
-    def write(self, outs, windows=(os.name == 'nt')):
-        if windows:
-            outs.write('set {name}={value}\n'.format(**vars(self)))
-        else:
-            outs.write(
-                '{name}="{value}"\nexport {name}\n'.format(**vars(self)))
+    def render_windows(self):
+        return 'set ' + self.name + '=' + self.value + '\n'
+
+    def render_posix(self):
+        return (self.name + '="' + self.value + '"\nexport ' + self.name +
+                '\n')
 
     def apply(self, env):
         env[self.name] = self.value
@@ -117,11 +131,11 @@ class Clear(_VariableAction):
         kwargs['allow_empty_values'] = True
         super(Clear, self).__init__(*args, **kwargs)
 
-    def write(self, outs, windows=(os.name == 'nt')):
-        if windows:
-            outs.write('set {name}=\n'.format(**vars(self)))
-        else:
-            outs.write('unset {name}\n'.format(**vars(self)))
+    def render_windows(self):
+        return 'set ' + self.name + '=\n'
+
+    def render_posix(self):
+        return 'unset ' + self.name + '\n'
 
     def apply(self, env):
         if self.name in env:
@@ -134,27 +148,24 @@ class Remove(_VariableAction):
         super(Remove, self).__init__(name, value, *args, **kwargs)
         self._pathsep = pathsep
 
-    def write(self, outs, windows=(os.name == 'nt')):
-        if windows:
-            outs.write(':: Remove\n::   {value}\n:: from\n::   {name}\n'
-                       ':: before adding it back.\n'
-                       'set {name}=%{name}:{value}{pathsep}=%\n'.format(
-                           name=self.name,
-                           value=self.value,
-                           pathsep=self._pathsep))
-
-        else:
-            outs.write('# Remove \n#   {value}\n# from\n#   {name}\n# before '
-                       'adding it back.\n'
-                       '{name}="$(echo "${name}"'
-                       ' | sed "s/{pathsep}{escvalue}{pathsep}/{pathsep}/g;"'
-                       ' | sed "s/^{escvalue}{pathsep}//g;"'
-                       ' | sed "s/{pathsep}{escvalue}$//g;"'
-                       ')"\nexport {name}\n'.format(
-                           name=self.name,
-                           value=self.value,
-                           escvalue=self.value.replace('/', '\\/'),
-                           pathsep=self._pathsep))
+    def render_windows(self):
+        return (':: Remove\n::   {value}\n:: from\n::   {name}\n'
+                ':: before adding it back.\n'
+                'set {name}=%{name}:{value}{pathsep}=%\n'.format(
+                    name=self.name, value=self.value, pathsep=self._pathsep))
+
+    def render_posix(self):
+        return ('# Remove \n#   {value}\n# from\n#   {name}\n# before '
+                'adding it back.\n'
+                '{name}="$(echo "${name}"'
+                ' | sed "s/{pathsep}{escvalue}{pathsep}/{pathsep}/g;"'
+                ' | sed "s/^{escvalue}{pathsep}//g;"'
+                ' | sed "s/{pathsep}{escvalue}$//g;"'
+                ')"\nexport {name}\n'.format(
+                    name=self.name,
+                    value=self.value,
+                    escvalue=self.value.replace('/', '\\/'),
+                    pathsep=self._pathsep))
 
     def apply(self, env):
         env[self.name] = env[self.name].replace(
@@ -174,21 +185,26 @@ def _append_prepend_check(action):
 
 class Prepend(_VariableAction):
     """Prepend a value to a PATH-like variable."""
-    def __init__(self, name, value, join, *args, **kwargs):
+    def __init__(self, name, value, pathsep, *args, **kwargs):
         super(Prepend, self).__init__(name, value, *args, **kwargs)
-        self._join = join
+        self._pathsep = pathsep
 
-    def write(self, outs, windows=(os.name == 'nt')):
-        if windows:
-            outs.write('set {name}={value}\n'.format(
-                name=self.name,
-                value=self._join(self.value, '%{}%'.format(self.name))))
-        else:
-            outs.write('{name}="{value}"\nexport {name}\n'.format(
-                name=self.name, value=self._join(self.value, '$' + self.name)))
+        # The rendered lines only depend on constructor arguments, so build
+        # them once here instead of on every render() call.
+        self._windows_line = ('set ' + name + '=' +
+                              pathsep.join((value, '%' + name + '%')) + '\n')
+        self._posix_line = (name + '="' + pathsep.join((value, '$' + name)) +
+                            '"\nexport ' + name + '\n')
+
+    def render_windows(self):
+        return self._windows_line
+
+    def render_posix(self):
+        return self._posix_line
 
     def apply(self, env):
-        env[self.name] = self._join(self.value, env.get(self.name, ''))
+        env[self.name] = self._pathsep.join(
+            (self.value, env.get(self.name, '')))
 
     def _check(self):
         super(Prepend, self)._check()
@@ -197,21 +213,26 @@ class Prepend(_VariableAction):
 
 class Append(_VariableAction):
     """Append a value to a PATH-like variable. (Uncommon, see Prepend.)"""
-    def __init__(self, name, value, join, *args, **kwargs):
+    def __init__(self, name, value, pathsep, *args, **kwargs):
         super(Append, self).__init__(name, value, *args, **kwargs)
-        self._join = join
+        self._pathsep = pathsep
 
-    def write(self, outs, windows=(os.name == 'nt')):
-        if windows:
-            outs.write('set {name}={value}\n'.format(
-                name=self.name,
-                value=self._join('%{}%'.format(self.name), self.value)))
-        else:
-            outs.write('{name}="{value}"\nexport {name}\n'.format(
-                name=self.name, value=self._join('$' + self.name, self.value)))
+        # The rendered lines only depend on constructor arguments, so build
+        # them once here instead of on every render() call.
+        self._windows_line = ('set ' + name + '=' +
+                              pathsep.join(('%' + name + '%', value)) + '\n')
+        self._posix_line = (name + '="' + pathsep.join(('$' + name, value)) +
+                            '"\nexport ' + name + '\n')
+
+    def render_windows(self):
+        return self._windows_line
+
+    def render_posix(self):
+        return self._posix_line
 
     def apply(self, env):
-        env[self.name] = self._join(env.get(self.name, ''), self.value)
+        env[self.name] = self._pathsep.join(
+            (env.get(self.name, ''), self.value))
 
     def _check(self):
         super(Append, self)._check()
@@ -232,25 +253,23 @@ class Echo(_Action):
         self.value = value
         self._newline = newline
 
-    def write(self, outs, windows=(os.name == 'nt')):
+    def render_windows(self):
         # POSIX shells parse arguments and pass to echo, but Windows seems to
         # pass the command line as is without parsing, so quoting is wrong.
-        if windows:
-            if self._newline:
-                if not self.value:
-                    outs.write('echo.\n')
-                else:
-                    outs.write('echo {}\n'.format(self.value))
-            else:
-                outs.write('<nul set /p="{}"\n'.format(self.value))
-        else:
-            # TODO(mohrr) use shlex.quote().
-            outs.write('if [ -z "${PW_ENVSETUP_QUIET:-}" ]; then\n')
-            if self._newline:
-                outs.write('  echo "{}"\n'.format(self.value))
-            else:
-                outs.write('  echo -n "{}"\n'.format(self.value))
-            outs.write('fi\n')
+        if self._newline:
+            if not self.value:
+                return 'echo.\n'
+            return 'echo ' + self.value + '\n'
+        return '<nul set /p="' + self.value + '"\n'
+
+    def render_posix_body(self):
+        """Returns the echo command without the PW_ENVSETUP_QUIET check."""
+        if self._newline:
+            return '  echo ' + _quote(self.value) + '\n'
+        return '  echo -n ' + _quote(self.value) + '\n'
+
+    def render_posix(self):
+        return _POSIX_QUIET_START + self.render_posix_body() + _POSIX_QUIET_END
 
     def apply(self, env):  # pylint: disable=no-self-use
         del env  # Unused.
@@ -262,10 +281,15 @@ class Comment(_Action):
         super(Comment, self).__init__(*args, **kwargs)
         self.value = value
 
-    def write(self, outs, windows=(os.name == 'nt')):
-        comment_char = '::' if windows else '#'
-        for line in self.value.splitlines():
-            outs.write('{} {}\n'.format(comment_char, line))
+    def _render(self, comment_char):
+        return ''.join('{} {}\n'.format(comment_char, line)
+                       for line in self.value.splitlines())
+
+    def render_windows(self):
+        return self._render('::')
+
+    def render_posix(self):
+        return self._render('#')
 
     def apply(self, env):  # pylint: disable=no-self-use
         del env  # Unused.
@@ -280,44 +304,50 @@ class Command(_Action):
         self.command = command
         self.exit_on_error = exit_on_error
 
-    def write(self, outs, windows=(os.name == 'nt')):
+    def _render_command(self):
         # TODO(mohrr) use shlex.quote here?
-        outs.write('{}\n'.format(' '.join(self.command)))
+        return '{}\n'.format(' '.join(self.command))
+
+    def render_windows(self):
+        result = self._render_command()
         if not self.exit_on_error:
-            return
+            return result
+        return result + 'if %ERRORLEVEL% neq 0 goto {}\n'.format(
+            _SCRIPT_END_LABEL)
 
-        if windows:
-            outs.write(
-                'if %ERRORLEVEL% neq 0 goto {}\n'.format(_SCRIPT_END_LABEL))
-        else:
-            # Assume failing command produced relevant output.
-            outs.write('if [ "$?" -ne 0 ]; then\n  return 1\nfi\n')
+    def render_posix(self):
+        result = self._render_command()
+        if not self.exit_on_error:
+            return result
+        # Assume failing command produced relevant output.
+        return result + 'if [ "$?" -ne 0 ]; then\n  return 1\nfi\n'
 
 
 class BlankLine(_Action):
     """Write a blank line to the init script."""
-    def write(  # pylint: disable=no-self-use
-        self, outs, windows=(os.name == 'nt')):
-        del windows  # Unused.
-        outs.write('\n')
+    def render_windows(self):  # pylint: disable=no-self-use
+        return '\n'
+
+    def render_posix(self):  # pylint: disable=no-self-use
+        return '\n'
 
     def apply(self, env):  # pylint: disable=no-self-use
         del env  # Unused.
 
 
 class Hash(_Action):
-    def write(self, outs, windows=(os.name == 'nt')):  # pylint: disable=no-self-use
-        if windows:
-            return
+    def render_windows(self):  # pylint: disable=no-self-use
+        return ''
 
-        outs.write('''
+    def render_posix(self):  # pylint: disable=no-self-use
+        return '''
 # This should detect bash and zsh, which have a hash command that must be
 # called to get it to forget past commands. Without forgetting past
 # commands the $PATH changes we made may not be respected.
 if [ -n "${BASH:-}" -o -n "${ZSH_VERSION:-}" ] ; then
   hash -r\n
 fi
-''')
+'''
 
     def apply(self, env):  # pylint: disable=no-self-use
         del env  # Unused.
@@ -341,10 +371,17 @@ class Environment(object):
         self._windows = windows
         self._allcaps = allcaps
 
-    def _join(self, *args):
-        if len(args) == 1 and isinstance(args[0], (list, tuple)):
-            args = args[0]
-        return self._pathsep.join(args)
+        # Maps variable names touched by set(), clear(), append() or
+        # prepend() to whether they are defined afterwards. Lets those
+        # methods check for existing values without replaying every action.
+        # remove() may leave an empty value, so it drops the name from here.
+        self._defined = {}
+
+    def _is_defined(self, name):
+        """Returns whether name has a non-empty value in this environment."""
+        if name in self._defined:
+            return self._defined[name]
+        return bool(self._evaluate(name).get(name))
 
     def normalize_key(self, name):
         if self._allcaps:
@@ -363,20 +400,23 @@ class Environment(object):
         """Set a variable."""
         name = self.normalize_key(name)
         self._actions.append(Set(name, value))
+        self._defined[name] = True
         self._blankline()
 
     def clear(self, name):
         """Remove a variable."""
         name = self.normalize_key(name)
         self._actions.append(Clear(name))
+        self._defined[name] = False
         self._blankline()
 
     def _remove(self, name, value):
         """Remove a value from a variable."""
 
         name = self.normalize_key(name)
-        if self.get(name, None):
+        if self._is_defined(name):
             self._actions.append(Remove(name, value, self._pathsep))
+            self._defined.pop(name, None)
 
     def remove(self, name, value):
         """Remove a value from a PATH-like variable."""
@@ -387,22 +427,24 @@ class Environment(object):
         """Add a value to a PATH-like variable. Rarely used, see prepend()."""
 
         name = self.normalize_key(name)
-        if self.get(name, None):
+        if self._is_defined(name):
             self._remove(name, value)
-            self._actions.append(Append(name, value, self._join))
+            self._actions.append(Append(name, value, self._pathsep))
         else:
             self._actions.append(Set(name, value))
+        self._defined[name] = True
         self._blankline()
 
     def prepend(self, name, value):
         """Add a value to the beginning of a PATH-like variable."""
 
         name = self.normalize_key(name)
-        if self.get(name, None):
+        if self._is_defined(name):
             self._remove(name, value)
-            self._actions.append(Prepend(name, value, self._join))
+            self._actions.append(Prepend(name, value, self._pathsep))
         else:
             self._actions.append(Set(name, value))
+        self._defined[name] = True
         self._blankline()
 
     def echo(self, value='', newline=True):
@@ -433,14 +475,51 @@ class Environment(object):
 
     def write(self, outs):
         """Writes a shell init script to outs."""
+        parts = ['@echo off\n'] if self._windows else []
+
+        # Pick the platform-specific renderer once for the whole script rather
+        # than branching on the platform inside every action.
         if self._windows:
-            outs.write('@echo off\n')
+            parts.extend(action.render_windows() for action in self._actions)
+            parts.append(':{}\n'.format(_SCRIPT_END_LABEL))
+        else:
+            self._render_posix(parts)
 
+        # Emit the whole script with a single write rather than one or more
+        # small writes per action.
+        outs.write(''.join(parts))
+
+    def _render_posix(self, parts):
+        """Appends the POSIX init script to parts.
+
+        Consecutive echoes, including blank lines between them, share a single
+        PW_ENVSETUP_QUIET check instead of each getting their own.
+        """
+        in_echo = False
+        blanklines = []
         for action in self._actions:
-            action.write(outs, windows=self._windows)
+            if isinstance(action, Echo):
+                if not in_echo:
+                    parts.append(_POSIX_QUIET_START)
+                    in_echo = True
+                parts.extend(blanklines)
+                del blanklines[:]
+                parts.append(action.render_posix_body())
 
-        if self._windows:
-            outs.write(':{}\n'.format(_SCRIPT_END_LABEL))
+            elif in_echo and isinstance(action, BlankLine):
+                blanklines.append(action.render_posix())
+
+            else:
+                if in_echo:
+                    parts.append(_POSIX_QUIET_END)
+                    parts.extend(blanklines)
+                    del blanklines[:]
+                    in_echo = False
+                parts.append(action.render_posix())
+
+        if in_echo:
+            parts.append(_POSIX_QUIET_END)
+            parts.extend(blanklines)
 
     @contextlib.contextmanager
     def __call__(self, export=True):
@@ -459,31 +538,67 @@ class Environment(object):
 
         Yields the new environment object.
         """
+        # (name, original value or None) for each variable modified while
+        # exporting, recorded before the first change to that variable.
+        restore = []
         try:
             if export:
-                orig_env = os.environ.copy()
                 env = os.environ
+                seen = set()
+                for action in self._actions:
+                    if (isinstance(action, _VariableAction)
+                            and action.name not in seen):
+                        seen.add(action.name)
+                        restore.append((action.name, env.get(action.name)))
+                    action.apply(env)
             else:
                 env = os.environ.copy()
-
-            for action in self._actions:
-                action.apply(env)
+                for action in self._actions:
+                    action.apply(env)
 
             yield env
 
         finally:
-            if export:
-                for action in self._actions:
-                    action.unapply(env=os.environ, orig_env=orig_env)
+            for name, value in restore:
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+    def _evaluate(self, key):
+        """Returns {key: value} for key, or {} if key is not defined.
+
+        Only replays the actions that touch key, starting from the last Set or
+        Clear of it, instead of copying os.environ and replaying everything.
+        """
+        actions = []
+        for action in reversed(self._actions):
+            if not isinstance(action, _VariableAction) or action.name != key:
+                continue
+            actions.append(action)
+            if isinstance(action, (Set, Clear)):
+                env = {}
+                break
+        else:
+            env = {}
+            try:
+                if key in os.environ:
+                    env[key] = os.environ[key]
+            except TypeError:
+                # os.environ only accepts str keys. Like a plain dict, treat
+                # keys of any other type as not defined.
+                pass
+
+        for action in reversed(actions):
+            action.apply(env)
+        return env
 
     def get(self, key, default=None):
         """Get the value of a variable within context of this object."""
         key = self.normalize_key(key)
-        with self(export=False) as env:
-            return env.get(key, default)
+        return self._evaluate(key).get(key, default)
 
     def __getitem__(self, key):
         """Get the value of a variable within context of this object."""
         key = self.normalize_key(key)
-        with self(export=False) as env:
-            return env[key]
+        return self._evaluate(key)[key]
@@ -23,11 +23,13 @@ evaluated by the shell, then launches the shell and then saves the environment.
 This environment is then validated in the test process.
 """
 
+import io
 import logging
 import os
 import subprocess
 import tempfile
 import unittest
+from unittest import mock
 
 from pw_env_setup import environment
 
@@ -164,6 +166,26 @@ class EnvironmentTest(unittest.TestCase):
             self.assertIn(self.var_not_set, env)
             self.assertIn(self.var_not_set, os.environ)
 
+    def test_write_single_call(self):
+        self.env.set(self.var_not_set, '1')
+        self.env.prepend(self.var_already_set, 'path')
+        self.env.echo('hello')
+        self.env.hash()
+
+        outs = mock.Mock()
+        self.env.write(outs)
+        outs.write.assert_called_once()
+
+        written = io.StringIO()
+        self.env.write(written)
+        self.assertEqual(outs.write.call_args[0][0], written.getvalue())
+
+    def test_get_badnametype(self):
+        self.assertIsNone(self.env.get(123))
+        self.assertEqual(self.env.get(123, 'default'), 'default')
+        with self.assertRaises(KeyError):
+            _ = self.env[123]
+
     def test_set_badnametype(self):
         with self.assertRaises(environment.BadNameType):
             self.env.set(123, '123')
@@ -297,6 +319,53 @@ class _AppendPrependTestMixin(object):
         env = _evaluate_env_in_shell(self.env)
         self.assertEqual(env[self.var_not_set], 'path')
 
+    def test_prepend_cleared_ctx(self):
+        self.env.clear(self.var_already_set)
+        self.env.prepend(self.var_already_set, 'path')
+        with self.env(export=False) as env:
+            self.assertEqual(env[self.var_already_set], 'path')
+
+    def test_prepend_after_remove_emptied_ctx(self):
+        self.env.set(self.var_not_set, 'path' + self.pathsep)
+        self.env.remove(self.var_not_set, 'path')
+        self.env.prepend(self.var_not_set, 'other')
+        with self.env(export=False) as env:
+            self.assertEqual(env[self.var_not_set], 'other')
+
+    def test_prepend_twice_ctx(self):
+        self.env.prepend(self.var_not_set, 'one')
+        self.env.prepend(self.var_not_set, 'two')
+        with self.env(export=False) as env:
+            self.assertEqual(env[self.var_not_set],
+                             self.pathsep.join(('two', 'one')))
+
+    def test_prepend_present_global(self):
+        orig = os.environ[self.var_already_set]
+        self.env.prepend(self.var_already_set, 'path')
+        self.env.prepend(self.var_not_set, 'path')
+        with self.env(export=True):
+            self.assertEqual(os.environ[self.var_already_set],
+                             self.pathsep.join(('path', orig)))
+            self.assertEqual(os.environ[self.var_not_set], 'path')
+        self.assertEqual(os.environ[self.var_already_set], orig)
+        self.assertNotIn(self.var_not_set, os.environ)
+
+    def test_get_prepend_present(self):
+        orig = os.environ[self.var_already_set]
+        self.env.prepend(self.var_already_set, 'path')
+        self.assertEqual(self.env.get(self.var_already_set),
+                         self.pathsep.join(('path', orig)))
+        self.assertEqual(self.env[self.var_already_set],
+                         self.pathsep.join(('path', orig)))
+
+    def test_get_cleared(self):
+        self.env.set(self.var_not_set, 'path')
+        self.env.clear(self.var_not_set)
+        self.assertIsNone(self.env.get(self.var_not_set))
+        self.assertEqual(self.env.get(self.var_not_set, 'default'), 'default')
+        with self.assertRaises(KeyError):
+            _ = self.env[self.var_not_set]
+
     def test_append_present_ctx(self):
         orig = os.environ[self.var_already_set]
         self.env.append(self.var_already_set, 'path')
@@ -401,6 +470,19 @@ class PosixEnvironmentTest(_PrependAppendEnvironmentTest,
         super(PosixEnvironmentTest, self).__init__(*args, **kwargs)
         self.real_windows = (os.name == 'nt')
 
+    def test_echo_grouped(self):
+        self.env.echo('one')
+        self.env.echo()
+        self.env.echo('two $PATH', newline=False)
+        self.env.set(self.var_not_set, '1')
+        self.env.echo('three')
+
+        outs = io.StringIO()
+        self.env.write(outs)
+        script = outs.getvalue()
+        self.assertEqual(script.count('PW_ENVSETUP_QUIET'), 2)
+        self.assertIn("  echo -n 'two $PATH'\n", script)
+
 
 class WindowsCaseInsensitiveTest(unittest.TestCase):
     def test_lower_handling(self):
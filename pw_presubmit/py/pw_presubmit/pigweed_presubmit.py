@@ -46,6 +46,20 @@ _LOG = logging.getLogger(__name__)
 #
 # Initialization
 #
+def _prepend_to_path(*paths) -> None:
+    """Moves paths to the front of PATH, removing any existing copies.
+
+    This keeps PATH from growing when the init steps run more than once.
+    """
+    new_entries = [str(path) for path in paths]
+    current = os.environ.get('PATH')
+    existing = current.split(os.pathsep) if current else []
+    entries = new_entries + [x for x in existing if x not in new_entries]
+    path = os.pathsep.join(entries)
+    if current != path:
+        os.environ['PATH'] = path
+
+
 def init_cipd(ctx: PresubmitContext):
     # TODO(mohrr) invoke by importing rather than by subprocess.
     call(
@@ -59,9 +73,7 @@ def init_cipd(ctx: PresubmitContext):
         paths.append(base)
         paths.append(base.joinpath('bin'))
 
-    paths.append(Path(os.environ['PATH']))
-
-    os.environ['PATH'] = os.pathsep.join(str(x) for x in paths)
+    _prepend_to_path(*paths)
     _LOG.debug('PATH %s', os.environ['PATH'])
 
 
@@ -81,10 +93,7 @@ def init_virtualenv(ctx: PresubmitContext):
                 virtualenv_source.joinpath('requirements.txt')),
         )
 
-    os.environ['PATH'] = os.pathsep.join((
-        str(ctx.output_directory.joinpath('bin')),
-        os.environ['PATH'],
-    ))
+    _prepend_to_path(ctx.output_directory.joinpath('bin'))
 
 
 INIT: Tuple[Callable, ...] = (
@@ -0,0 +1,58 @@
+# Copyright 2020 The Pigweed Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Tests for pw_presubmit.pigweed_presubmit."""
+
+import os
+from pathlib import Path
+import unittest
+from unittest import mock
+
+from pw_presubmit import pigweed_presubmit
+
+# pylint: disable=protected-access
+
+
+class TestPrependToPath(unittest.TestCase):
+    """Tests for pigweed_presubmit._prepend_to_path."""
+    def setUp(self):
+        self.cipd = [Path('/o/cipd'), Path('/o/cipd/bin')]
+        self.venv = Path('/o/venv/bin')
+        self.expected = os.pathsep.join(
+            str(x) for x in (self.venv, *self.cipd, '/usr/bin'))
+
+    def _run_init(self):
+        # Mirrors the PATH updates made by init_cipd and init_virtualenv.
+        pigweed_presubmit._prepend_to_path(*self.cipd)
+        pigweed_presubmit._prepend_to_path(self.venv)
+
+    def test_prepend(self):
+        with mock.patch.dict(os.environ, {'PATH': '/usr/bin'}):
+            self._run_init()
+            self.assertEqual(os.environ['PATH'], self.expected)
+
+    def test_repeated_init_does_not_grow_path(self):
+        with mock.patch.dict(os.environ, {'PATH': '/usr/bin'}):
+            for _ in range(3):
+                self._run_init()
+                self.assertEqual(os.environ['PATH'], self.expected)
+
+    def test_existing_entries_moved_to_front(self):
+        path = os.pathsep.join(('/usr/bin', str(self.cipd[1])))
+        with mock.patch.dict(os.environ, {'PATH': path}):
+            self._run_init()
+            self.assertEqual(os.environ['PATH'], self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()